@@ -1,32 +1,96 @@
 from __future__ import annotations
-import datetime as dt, json, uuid
-from typing import List, Optional
+import asyncio, datetime as dt, logging, os, re, uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Annotated, Any, Awaitable, Dict, List, Optional, Set, Tuple
+import anyio.to_thread, orjson
 from fastapi import FastAPI, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, ConfigDict, Field, StringConstraints
+
+# Logging is configured by the application; the core modules only create their "mentora.*" loggers.
+# Configure it before importing them, since loading the engine module already logs (e.g. stale prompts.json).
+logging.basicConfig(
+    level=os.getenv("MENTORA_LOGLEVEL", "INFO"),
+    format="%(asctime)s [%(levelname)s] %(name)s: %(message)s"
+)
+log = logging.getLogger("mentora.api")
+
 from core.engine.mentor_engine import MentorEngine
 from utils.handle_user import validate_login
-from utils.handle_mentor_chat_history import init_db, save_chat, get_chats, get_chat_messages_with_state, save_user_preferences, get_user_preferences
+from utils.handle_mentor_chat_history import init_db, save_chat, save_chat_summary, get_chats, get_chat_state, get_chat_messages_with_state, save_user_preferences, get_user_preferences
 
-app = FastAPI(title="Mentora API", version="2.0")
-app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
+class ORJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson. Handlers return it directly to skip jsonable_encoder; response_model is kept for the schema."""
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content)
 
 engine = MentorEngine()
 
+# Every SQLite call runs in a worker thread; size the pools so DB work doesn't queue behind a handful of threads.
+# anyio's limiter (40 by default) is only ever raised, never lowered
+_THREADPOOL_SIZE = int(os.getenv("MENTORA_THREADPOOL_SIZE", "32"))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=_THREADPOOL_SIZE, thread_name_prefix="mentora-db"))
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    limiter.total_tokens = max(limiter.total_tokens, _THREADPOOL_SIZE)
+    await asyncio.to_thread(init_db)
+    yield
+    if _background:
+        await asyncio.gather(*_background, return_exceptions=True)
+
+app = FastAPI(title="Mentora API", version="2.0", default_response_class=ORJSONResponse, lifespan=lifespan)
+app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
+
+# Output ceilings per endpoint. Gemini keeps decoding until it stops or hits the limit, so a tight
+# ceiling bounds worst-case latency. 2.5-series thinking tokens count against it too, so leave headroom.
+MAX_TOKENS_INTRO = 1024
+MAX_TOKENS_CHAT = 1024
+MAX_TOKENS_TOPIC_PROMPTS = 512
+
+# Upper bounds on /chat payloads; anything larger is rejected with a 422 before it reaches the engine
+MAX_HISTORY_MESSAGES = 400
+MAX_MESSAGE_CHARS = 16384
+MAX_TOPICS_PER_BATCH = 16
+
+# How long a chat turn waits for history compaction before going out with the previous summary
+SUMMARY_WAIT_SECONDS = float(os.getenv("MENTORA_SUMMARY_WAIT_MS", "300")) / 1000
+
+# Work that outlives the request that started it; held here so it is not garbage-collected mid-flight
+_background: Set[asyncio.Task] = set()
+
+def _spawn(coro: Awaitable[Any]) -> "asyncio.Future[Any]":
+    task = asyncio.ensure_future(coro)
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+    return task
+
+# At most one history compaction per (user_id, chat_title); turns arriving while it runs wait on it
+# instead of summarizing an overlapping slice again
+_compactions: Dict[Tuple[str, str], "asyncio.Future[Tuple[str, int]]"] = {}
+
+# Anything that is not a letter, digit or space (str.isalnum semantics) is dropped from session titles
+_SAFE_TITLE_RE = re.compile(r"[^\w ]|_")
+
 class LoginRequest(BaseModel):
     user_id: str
     password: str
 
 class ChatMessage(BaseModel):
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
     role: str
-    content: str
+    content: Annotated[str, StringConstraints(max_length=MAX_MESSAGE_CHARS)]
     timestamp: Optional[float] = None
     audio_url: Optional[str] = None
 
 class ChatRequest(BaseModel):
     user_id: str
     chat_title: str
-    chat_history: List[ChatMessage]
+    chat_history: Annotated[List[ChatMessage], Field(max_length=MAX_HISTORY_MESSAGES)]
 
 class StartSessionRequest(BaseModel):
     user_id: str
@@ -39,9 +103,37 @@ class TopicPromptRequest(BaseModel):
     topic: str
     user_id: Optional[str] = None
 
-@app.on_event("startup")
-async def on_startup():
-    init_db()
+class TopicPromptsBatchRequest(BaseModel):
+    topics: Annotated[List[str], Field(min_length=1, max_length=MAX_TOPICS_PER_BATCH)]
+    user_id: Optional[str] = None
+
+class StartSessionResponse(BaseModel):
+    intro_and_topics: str
+    title: str
+    topics: List[str]
+    current_topic: Optional[str] = None
+    suggestions: List[str]
+
+class ChatResponse(BaseModel):
+    reply: str
+    suggestions: List[str]
+
+class ChatSummary(BaseModel):
+    title: str
+    updated_at: str
+
+class ChatListResponse(BaseModel):
+    chats: List[ChatSummary]
+
+class ChatMessagesResponse(BaseModel):
+    messages: List[ChatMessage]
+    state: Dict[str, Any]
+
+class TopicPromptsResponse(BaseModel):
+    prompts: List[str]
+
+class TopicPromptsBatchResponse(BaseModel):
+    prompts: Dict[str, List[str]]
 
 @app.get("/")
 async def root():
@@ -50,7 +142,7 @@ async def root():
 @app.post("/login")
 async def login(req: LoginRequest):
     try:
-        if not validate_login(req.user_id, req.password):
+        if not await asyncio.to_thread(validate_login, req.user_id, req.password):
             raise HTTPException(status_code=401, detail="Invalid credentials")
         return {"success": True, "user_id": req.user_id}
     except HTTPException:
@@ -58,10 +150,9 @@ async def login(req: LoginRequest):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Login failed: {e}")
 
-@app.post("/start_session")
+@app.post("/start_session", response_model=StartSessionResponse)
 async def start_session(req: StartSessionRequest):
     try:
-        save_user_preferences(user_id=req.user_id, learning_goal=req.learning_goal, skills=req.skills, difficulty=req.difficulty, role=req.role)
         context = []
         if req.learning_goal: context.append(f"Learning Goal: {req.learning_goal}")
         context.append(f"Skills/Interests: {', '.join(req.skills)}")
@@ -69,66 +160,158 @@ async def start_session(req: StartSessionRequest):
         context.append(f"User Role: {req.role}")
         context_str = "\n".join(context)
         extra = "You are a mentor who is very interactive and strict to particular domain. If someone asks something not related to that domain, give a polite fallback. Ask questions, quiz the user, summarize lessons, and check understanding."
-        intro, topics, suggestions = await engine.generate_intro_and_topics(context_description=context_str, extra_instructions=extra)
+        # Storing the preferences does not feed the prompt, so it overlaps the intro call
+        _, (intro, topics, suggestions) = await asyncio.gather(
+            asyncio.to_thread(save_user_preferences, user_id=req.user_id, learning_goal=req.learning_goal, skills=req.skills, difficulty=req.difficulty, role=req.role),
+            engine.generate_intro_and_topics(context_description=context_str, extra_instructions=extra, max_tokens=MAX_TOKENS_INTRO),
+        )
         current_topic = topics[0] if topics else None
         base_title_part = req.learning_goal or (req.skills[0] if req.skills else "Session")
-        safe = ''.join(c for c in base_title_part if c.isalnum() or c == ' ').strip().replace(' ', '_') or "Session"
+        safe = _SAFE_TITLE_RE.sub('', base_title_part).strip().replace(' ', '_') or "Session"
         session_title = f"{safe}_{dt.datetime.now().strftime('%Y%m%d%H%M%S')}_{str(uuid.uuid4())[:4]}"
         mentor_message = ChatMessage(role="assistant", content=(intro + "\n\nFeel free to ask questions anytime. Are you ready to begin?").replace("🔊","").strip(), timestamp=dt.datetime.now().timestamp(), audio_url=None)
-        save_chat(user_id=req.user_id, title=session_title, messages_json=json.dumps([mentor_message.model_dump()]), mentor_topics=topics, current_topic=current_topic, completed_topics=[])
-        return {"intro_and_topics": mentor_message.content, "title": session_title, "topics": topics, "current_topic": current_topic, "suggestions": suggestions}
+        await asyncio.to_thread(save_chat, user_id=req.user_id, title=session_title, mentor_topics=topics, current_topic=current_topic, completed_topics=[], new_messages=[mentor_message.model_dump()])
+        return ORJSONResponse({"intro_and_topics": mentor_message.content, "title": session_title, "topics": topics, "current_topic": current_topic, "suggestions": suggestions})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to start session: {e}")
 
-@app.post("/chat")
+async def _load_chat_context(req: ChatRequest) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """Prompt context for the engine, plus the stored `message_count`, `summary` and `summary_upto`."""
+    state, prefs = await asyncio.gather(
+        asyncio.to_thread(get_chat_state, req.user_id, req.chat_title),
+        asyncio.to_thread(get_user_preferences, req.user_id),
+    )
+    state = state or {}
+    prefs = prefs or {}
+    return {
+        "learning_goal": prefs.get("learning_goal"),
+        "skills": prefs.get("skills", []),
+        "difficulty": prefs.get("difficulty", "medium"),
+        "role": prefs.get("role", "default"),
+        "mentor_topics": state.get("mentor_topics", []),
+        "current_topic": state.get("current_topic"),
+        "completed_topics": state.get("completed_topics", []),
+    }, {"message_count": state.get("message_count", 0), "summary": state.get("summary", ""), "summary_upto": state.get("summary_upto", 0)}
+
+async def _save_chat_turn(req: ChatRequest, history: List[Dict[str, Any]], stored: Dict[str, Any], context: Dict[str, Any], reply: str) -> None:
+    # Only messages the database has not seen yet are written; the client normally resends the full history
+    history.append({"role": "assistant", "content": reply, "timestamp": dt.datetime.now().timestamp(), "audio_url": None})
+    start = min(stored["message_count"], len(history) - 1)
+    await asyncio.to_thread(save_chat, user_id=req.user_id, title=req.chat_title, mentor_topics=context["mentor_topics"], current_topic=context["current_topic"], completed_topics=context["completed_topics"], new_messages=history[start:], start_seq=start, summary=stored["summary"], summary_upto=stored["summary_upto"])
+
+async def _compact_and_store(chat: Tuple[str, str], history: List[Dict[str, Any]], summary: str, covered: int) -> Tuple[str, int]:
+    """Run one compaction and store an advanced summary itself, so the result survives the turn that started it."""
+    try:
+        summary, summary_upto = await engine.compact_history(history, summary=summary, covered=covered)
+        if summary_upto > covered:
+            try:
+                await asyncio.to_thread(save_chat_summary, chat[0], chat[1], summary, summary_upto)
+            except Exception as e:
+                log.warning("Failed to store summary for %s/%s: %s", chat[0], chat[1], e)
+        return summary, summary_upto
+    finally:
+        if _compactions.get(chat) is asyncio.current_task():
+            del _compactions[chat]
+
+async def _window_history(req: ChatRequest, history: List[Dict[str, Any]], stored: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Fold turns that slid out of the window into the stored summary and return the recent window.
+    If the chat's compaction takes longer than SUMMARY_WAIT_SECONDS, this turn is answered with the
+    previous summary and a wider window; the compaction keeps running and stores its own result.
+    """
+    if stored["summary_upto"] > len(history):  # history was reset or truncated by the client
+        stored["summary"], stored["summary_upto"] = "", 0
+    chat = (req.user_id, req.chat_title)
+    task = _compactions.get(chat)
+    if task is None:
+        task = _compactions[chat] = _spawn(_compact_and_store(chat, history, stored["summary"], stored["summary_upto"]))
+    done, _ = await asyncio.wait({task}, timeout=SUMMARY_WAIT_SECONDS)
+    if done and not task.cancelled() and task.exception() is None:
+        summary, summary_upto = task.result()
+        # A compaction started by an earlier turn may cover less than the stored summary, or more than a truncated history
+        if stored["summary_upto"] < summary_upto <= len(history):
+            stored["summary"], stored["summary_upto"] = summary, summary_upto
+    # Nothing folded yet (every chat shorter than the window): hand over the list itself rather than a full copy
+    return history[stored["summary_upto"]:] if stored["summary_upto"] else history
+
+@app.post("/chat", response_model=ChatResponse)
 async def chat(req: ChatRequest):
     try:
-        result = get_chat_messages_with_state(req.user_id, req.chat_title)
-        if result is None: chat_messages, state = [], {}
-        else: chat_messages, state = result
-        mentor_topics = state.get("mentor_topics", [])
-        current_topic = state.get("current_topic")
-        completed_topics = state.get("completed_topics", [])
-        prefs = get_user_preferences(req.user_id) or {}
-        learning_goal = prefs.get("learning_goal")
-        skills = prefs.get("skills", [])
-        difficulty = prefs.get("difficulty", "medium")
-        role = prefs.get("role", "default")
-        reply, suggestions = await engine.chat(chat_history=[m.model_dump() for m in req.chat_history], user_id=req.user_id, chat_title=req.chat_title, learning_goal=learning_goal, skills=skills, difficulty=difficulty, role=role, mentor_topics=mentor_topics, current_topic=current_topic, completed_topics=completed_topics)
-        mentor_message = ChatMessage(role="assistant", content=reply, timestamp=dt.datetime.now().timestamp(), audio_url=None)
-        updated = req.chat_history + [mentor_message]
-        save_chat(user_id=req.user_id, title=req.chat_title, messages_json=json.dumps([m.model_dump() for m in updated]), mentor_topics=mentor_topics, current_topic=current_topic, completed_topics=completed_topics)
-        return {"reply": reply, "suggestions": suggestions}
+        context, stored = await _load_chat_context(req)
+        history = req.model_dump(mode="python")["chat_history"]
+        window = await _window_history(req, history, stored)
+        reply, suggestions = await engine.chat(chat_history=window, user_id=req.user_id, chat_title=req.chat_title, summary=stored["summary"], max_tokens=MAX_TOKENS_CHAT, **context)
+        await _save_chat_turn(req, history, stored, context, reply)
+        return ORJSONResponse({"reply": reply, "suggestions": suggestions})
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Chat failed: {e}")
 
-@app.get("/get_chats")
+@app.post("/chat/stream")
+async def chat_stream(req: ChatRequest):
+    """Server-sent events: `delta` events carry reply text as it is generated, `done` carries the final reply and suggestions."""
+    try:
+        context, stored = await _load_chat_context(req)
+        history = req.model_dump(mode="python")["chat_history"]
+        window = await _window_history(req, history, stored)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Chat failed: {e}")
+
+    async def events():
+        try:
+            async for event in engine.stream_chat(chat_history=window, user_id=req.user_id, chat_title=req.chat_title, summary=stored["summary"], max_tokens=MAX_TOKENS_CHAT, **context):
+                if event["type"] == "delta":
+                    yield f"event: delta\ndata: {orjson.dumps({'text': event['text']}).decode()}\n\n"
+                else:
+                    await _save_chat_turn(req, history, stored, context, event["reply"])
+                    yield f"event: done\ndata: {orjson.dumps({'reply': event['reply'], 'suggestions': event['suggestions']}).decode()}\n\n"
+        except Exception as e:
+            yield f"event: error\ndata: {orjson.dumps({'detail': f'Chat failed: {e}'}).decode()}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+@app.get("/get_chats", response_model=ChatListResponse)
 async def list_chats(user_id: str = Query(..., description="User ID")):
     try:
-        return {"chats": get_chats(user_id)}
+        return ORJSONResponse({"chats": await asyncio.to_thread(get_chats, user_id)})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get chats: {e}")
 
-@app.get("/get_chat_messages")
-async def get_chat_messages_route(user_id: str = Query(..., description="User ID"), title: str = Query(..., description="Chat Title")):
+@app.get("/get_chat_messages", response_model=ChatMessagesResponse)
+async def get_chat_messages_route(user_id: str = Query(..., description="User ID"), title: str = Query(..., description="Chat Title"), limit: Optional[int] = Query(None, ge=1, description="Return only the most recent messages")):
     try:
-        result = get_chat_messages_with_state(user_id, title)
+        result = await asyncio.to_thread(get_chat_messages_with_state, user_id, title, limit)
         if result is None: messages, state = [], {}
         else: messages, state = result
-        return {"messages": messages, "state": state}
+        return ORJSONResponse({"messages": messages, "state": state})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get chat messages: {e}")
 
-@app.post("/get_topic_prompts")
+async def _topic_context(user_id: Optional[str]) -> str:
+    prefs = await asyncio.to_thread(get_user_preferences, user_id) if user_id else {}
+    if not prefs:
+        return ""
+    return f"Learning Goal: {prefs.get('learning_goal','')}\nSkills: {', '.join(prefs.get('skills',[]))}\nDifficulty: {prefs.get('difficulty','')}\nRole: {prefs.get('role','')}"
+
+def _fallback_topic_prompts(topic: str) -> List[str]:
+    return [f"What are the basics of {topic}?", f"Can you give me a real-world example of {topic}?", f"How do I apply {topic} in practice?", f"What are common mistakes in {topic}?"]
+
+@app.post("/get_topic_prompts", response_model=TopicPromptsResponse)
 async def get_topic_prompts(req: TopicPromptRequest):
     try:
-        prefs = get_user_preferences(req.user_id) if req.user_id else {}
-        context = ""
-        if prefs:
-            context = f"Learning Goal: {prefs.get('learning_goal','')}\nSkills: {', '.join(prefs.get('skills',[]))}\nDifficulty: {prefs.get('difficulty','')}\nRole: {prefs.get('role','')}"
-        prompts = await engine.generate_topic_prompts(req.topic, context_description=context)
-        return {"prompts": prompts}
+        context = await _topic_context(req.user_id)
+        prompts = await engine.generate_topic_prompts(req.topic, context_description=context, max_tokens=MAX_TOKENS_TOPIC_PROMPTS)
+        return ORJSONResponse({"prompts": prompts})
+    except Exception:
+        return ORJSONResponse({"prompts": _fallback_topic_prompts(req.topic)})
+
+@app.post("/get_topic_prompts/batch", response_model=TopicPromptsBatchResponse)
+async def get_topic_prompts_batch(req: TopicPromptsBatchRequest):
+    """Prompts for several topics in one request, generated concurrently."""
+    try:
+        context = await _topic_context(req.user_id)
+        prompts = await engine.generate_topic_prompts_many(req.topics, context_description=context, max_tokens=MAX_TOKENS_TOPIC_PROMPTS)
+        return ORJSONResponse({"prompts": prompts})
     except Exception:
-        return {"prompts": [f"What are the basics of {req.topic}?", f"Can you give me a real-world example of {req.topic}?", f"How do I apply {req.topic} in practice?", f"What are common mistakes in {req.topic}?"]}
\ No newline at end of file
+        return ORJSONResponse({"prompts": {t: _fallback_topic_prompts(t) for t in req.topics}})
\ No newline at end of file
@@ -0,0 +1,240 @@
+from __future__ import annotations
+import asyncio, datetime as _dt, hashlib, logging, math, os, re, sqlite3, threading, zlib
+from array import array
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, List, Optional, Tuple
+import orjson
+try:
+    import numpy as _np
+except ImportError:  # numpy is optional; similarity falls back to pure Python
+    _np = None
+
+log = logging.getLogger("mentora.cache")
+
+_DB_DIR = Path(__file__).resolve().parent.parent / "data"
+_DB_PATH = _DB_DIR / "response_cache.db"
+
+def make_key(payload: Any) -> str:
+    """Stable 128-bit digest of a JSON-serializable request payload."""
+    return hashlib.blake2b(orjson.dumps(payload, option=orjson.OPT_SORT_KEYS), digest_size=16).hexdigest()
+
+class ResponseCache:
+    """
+    Two-tier cache for LLM completions: a bounded in-process LRU for the hot set,
+    backed by SQLite so entries survive restarts. Only the key hash is stored,
+    never the prompt itself. Disk reads run in a worker thread and disk writes are
+    fire-and-forget, so the event loop never waits on SQLite; rows older than the
+    TTL or beyond the row cap are pruned as new ones are written.
+    """
+
+    _PRUNE_EVERY = 256
+
+    def __init__(self, path: Optional[Path] = None, max_entries: Optional[int] = None) -> None:
+        self._path = Path(path or _DB_PATH)
+        self._max_entries = max_entries or int(os.getenv("MENTORA_RESPONSE_CACHE_SIZE", "1024"))
+        self._max_rows = int(os.getenv("MENTORA_RESPONSE_CACHE_ROWS", "50000"))
+        self._ttl = _dt.timedelta(days=float(os.getenv("MENTORA_RESPONSE_CACHE_TTL_DAYS", "30")))
+        self._hot: "OrderedDict[str, str]" = OrderedDict()
+        # Separate locks so a hot-tier lookup on the event loop never waits behind a disk write
+        self._hot_lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._writes = 0
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(self._path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS response_cache (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                created_at TEXT NOT NULL
+            )
+            """
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_response_cache_created ON response_cache(created_at)")
+        self._prune()
+        self._db.commit()
+        log.debug("Response cache ready at %s (hot entries=%d, rows<=%d)", self._path, self._max_entries, self._max_rows)
+
+    def _cutoff(self) -> str:
+        return (_dt.datetime.utcnow() - self._ttl).isoformat()
+
+    def _remember(self, key: str, text: str) -> None:
+        with self._hot_lock:
+            self._hot[key] = text
+            self._hot.move_to_end(key)
+            while len(self._hot) > self._max_entries:
+                self._hot.popitem(last=False)
+
+    def _get_hot(self, key: str) -> Optional[str]:
+        with self._hot_lock:
+            text = self._hot.get(key)
+            if text is not None:
+                self._hot.move_to_end(key)
+            return text
+
+    def _load(self, key: str) -> Optional[str]:
+        with self._db_lock:
+            row = self._db.execute("SELECT response FROM response_cache WHERE key=? AND created_at>=?", (key, self._cutoff())).fetchone()
+        if row is None:
+            return None
+        self._remember(key, row[0])
+        return row[0]
+
+    def _prune(self) -> None:
+        self._db.execute("DELETE FROM response_cache WHERE created_at<?", (self._cutoff(),))
+        self._db.execute(
+            "DELETE FROM response_cache WHERE key IN (SELECT key FROM response_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+            (self._max_rows,),
+        )
+
+    def _persist(self, key: str, text: str) -> None:
+        with self._db_lock:
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO response_cache (key, response, created_at) VALUES (?, ?, ?)",
+                    (key, text, _dt.datetime.utcnow().isoformat()),
+                )
+                self._writes += 1
+                if self._writes % self._PRUNE_EVERY == 0:
+                    self._prune()
+                self._db.commit()
+            except sqlite3.Error as e:
+                log.warning("Failed to persist cache entry: %s", e)
+
+    def get(self, key: str) -> Optional[str]:
+        """Blocking lookup for callers outside the event loop."""
+        text = self._get_hot(key)
+        return text if text is not None else self._load(key)
+
+    async def aget(self, key: str) -> Optional[str]:
+        text = self._get_hot(key)
+        if text is not None:
+            return text
+        return await asyncio.to_thread(self._load, key)
+
+    def set(self, key: str, text: str) -> None:
+        """Remember `text` now; on the event loop the disk write is handed to a worker thread and not awaited."""
+        self._remember(key, text)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._persist(key, text)
+        else:
+            loop.run_in_executor(None, self._persist, key, text)
+
+# Keeps the symbols that tell languages apart: "C" vs "C++" vs "C#", "node.js", "F#"
+_TOKEN_RE = re.compile(r"\w(?:[\w.]*\w)?[+#]*")
+# Word pairs are few next to trigrams, so they are weighted up to make word order count
+_BIGRAM_WEIGHT = 2.0
+
+def _embed(text: str, dims: int) -> List[float]:
+    """
+    Cheap local embedding: signed feature hashing of words, their character trigrams and
+    adjacent word pairs. The word pairs make it order-sensitive, so "Java to Python" and
+    "Python to Java" do not collide.
+    """
+    vec = [0.0] * dims
+    tokens = _TOKEN_RE.findall(text.lower())
+    features: List[Tuple[str, float]] = []
+    for token in tokens:
+        padded = f"#{token}#"
+        features.append((token, 1.0))
+        features.extend((padded[i:i + 3], 1.0) for i in range(len(padded) - 2))
+    features.extend((f"{a} {b}", _BIGRAM_WEIGHT) for a, b in zip(tokens, tokens[1:]))
+    for feature, weight in features:
+        h = zlib.crc32(feature.encode("utf-8"))
+        vec[h % dims] += weight if h & 0x80000000 else -weight
+    return vec
+
+def _normalize(text: str) -> str:
+    return " ".join(_TOKEN_RE.findall(text.lower()))
+
+def _exact_tokens(normalized: str) -> frozenset:
+    """Tokens with digits or symbols ("c++", "python3", "3.12") are names, so a near match must agree on them exactly."""
+    return frozenset(t for t in normalized.split() if not t.isalpha())
+
+def _quantize(vec: List[float]) -> Tuple[bytes, float]:
+    """Scale to the int8 range; returns the packed vector and its L2 norm."""
+    peak = max((abs(x) for x in vec), default=0.0) or 1.0
+    q = array("b", (int(round(x * 127 / peak)) for x in vec))
+    return q.tobytes(), math.sqrt(sum(x * x for x in q))
+
+class _Bucket:
+    __slots__ = ("vectors", "norms", "texts", "values")
+
+    def __init__(self) -> None:
+        self.vectors = bytearray()
+        self.norms: List[float] = []
+        self.texts: List[str] = []
+        self.values: List[Any] = []
+
+class SemanticCache:
+    """
+    Similarity cache for short prompts such as topic names. Entries are grouped by
+    namespace (e.g. role + learner context) and stored as int8 vectors, so a bucket
+    stays a few hundred bytes per entry and lookups are integer dot products.
+    """
+
+    def __init__(self, threshold: float = 0.95, dims: int = 256, max_per_namespace: int = 64, max_namespaces: int = 256) -> None:
+        self.threshold = threshold
+        self.dims = dims
+        self._max_per_namespace = max_per_namespace
+        self._max_namespaces = max_namespaces
+        self._buckets: "OrderedDict[str, _Bucket]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _scores(self, bucket: _Bucket, q: bytes) -> List[int]:
+        if _np is not None:
+            mat = _np.frombuffer(bytes(bucket.vectors), dtype=_np.int8).reshape(-1, self.dims).astype(_np.int32)
+            return (mat @ _np.frombuffer(q, dtype=_np.int8).astype(_np.int32)).tolist()
+        qv = array("b", q)
+        rows = array("b", bucket.vectors)
+        d = self.dims
+        return [sum(a * b for a, b in zip(qv, rows[i * d:(i + 1) * d])) for i in range(len(bucket.norms))]
+
+    def get(self, namespace: str, text: str) -> Optional[Any]:
+        normalized = _normalize(text)
+        q, q_norm = _quantize(_embed(normalized, self.dims))
+        if not q_norm:
+            return None
+        with self._lock:
+            bucket = self._buckets.get(namespace)
+            if bucket is None or not bucket.norms:
+                return None
+            self._buckets.move_to_end(namespace)
+            scores = self._scores(bucket, q)
+            best = max(range(len(scores)), key=lambda i: scores[i] / (bucket.norms[i] or 1.0))
+            similarity = scores[best] / ((bucket.norms[best] or 1.0) * q_norm)
+            if similarity < self.threshold:
+                return None
+            stored = bucket.texts[best]
+            if stored != normalized and _exact_tokens(stored) != _exact_tokens(normalized):
+                log.debug("Semantic cache near miss rejected: %r vs %r", stored, normalized)
+                return None
+            log.debug("Semantic cache hit (similarity=%.3f)", similarity)
+            return bucket.values[best]
+
+    def set(self, namespace: str, text: str, value: Any) -> None:
+        normalized = _normalize(text)
+        q, q_norm = _quantize(_embed(normalized, self.dims))
+        if not q_norm:
+            return
+        with self._lock:
+            bucket = self._buckets.get(namespace)
+            if bucket is None:
+                bucket = self._buckets[namespace] = _Bucket()
+                while len(self._buckets) > self._max_namespaces:
+                    self._buckets.popitem(last=False)
+            self._buckets.move_to_end(namespace)
+            if len(bucket.norms) >= self._max_per_namespace:
+                del bucket.vectors[:self.dims]
+                del bucket.norms[0]
+                del bucket.texts[0]
+                del bucket.values[0]
+            bucket.vectors += q
+            bucket.norms.append(q_norm)
+            bucket.texts.append(normalized)
+            bucket.values.append(value)
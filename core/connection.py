@@ -1,14 +1,14 @@
 from __future__ import annotations
-import os, json, logging
-from typing import Any, Dict, List, Optional, Tuple
+import asyncio, os, logging, re
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
 import google.generativeai as genai
+import orjson
 from dotenv import load_dotenv
+from core.cache import ResponseCache, make_key
 
 log = logging.getLogger("mentora.connection")
-logging.basicConfig(
-    level=os.getenv("MENTORA_LOGLEVEL", "INFO"),
-    format="%(asctime)s [%(levelname)s] %(name)s: %(message)s"
-)
 
 def clean_schema(schema: dict) -> dict:
     """
@@ -30,6 +30,69 @@ def clean_schema(schema: dict) -> dict:
             cleaned[key] = value
     return cleaned
 
+_HARM_CATEGORIES = (
+    "HARM_CATEGORY_HARASSMENT",
+    "HARM_CATEGORY_HATE_SPEECH",
+    "HARM_CATEGORY_SEXUALLY_EXPLICIT",
+    "HARM_CATEGORY_DANGEROUS_CONTENT",
+)
+
+_JSON_RESPONSE_SCHEMA = clean_schema({
+    "type": "object",
+    "properties": {
+        "greeting": {"type": "string"},
+        "topics": {"type": "array", "items": {"type": "string"}},
+        "concluding_question": {"type": "string"},
+        "suggestions": {"type": "array", "items": {"type": "string"}},
+        "response": {"type": "string"},
+        "reply": {"type": "string"}
+    }
+})
+
+# Returned in place of a completion when the model call fails, or its JSON-mode reply does not parse
+FALLBACK_REPLY = "Sorry, I had trouble generating a response."
+FORMAT_ERROR_REPLY = "I apologize, but I'm having trouble formatting my response properly. Could you please try again?"
+
+# Markdown code fences wrapping the whole reply, and the characters that matter when scanning for a JSON object
+_FENCE_RE = re.compile(r"\A\s*```(?:json)?\s*|\s*```\s*\Z")
+_JSON_STRUCTURE_RE = re.compile(r'[{}"\\]')
+
+def extract_first_json_object(text: str) -> Optional[str]:
+    """Single pass over `text` returning its first balanced {...} span, ignoring braces inside strings."""
+    start = text.find("{")
+    if start == -1:
+        return None
+    depth, in_string, skip_to = 0, False, start
+    # Jump between braces, quotes and backslashes instead of stepping through every character
+    for m in _JSON_STRUCTURE_RE.finditer(text, start):
+        i = m.start()
+        if i < skip_to:  # character escaped by the preceding backslash
+            continue
+        ch = m.group()
+        if in_string:
+            if ch == "\\":
+                skip_to = i + 2
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch == "{":
+            depth += 1
+        elif ch == "}":
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return None
+
+@lru_cache(maxsize=32)
+def _cached_generation_config(temperature: float, max_tokens: int, json_mode: bool):
+    cfg = {"temperature": temperature, "max_output_tokens": max_tokens}
+    if json_mode:
+        cfg["response_mime_type"] = "application/json"
+        cfg["response_schema"] = _JSON_RESPONSE_SCHEMA
+    log.debug("Built generation config: %s", cfg)
+    return genai.types.GenerationConfig(**cfg)
+
 class Connection:
     def __init__(self) -> None:
         log.debug("Loading environment variables...")
@@ -45,17 +108,16 @@ class Connection:
         genai.configure(api_key=api_key)
 
         threshold = os.getenv("GEMINI_SAFETY_THRESHOLD", "BLOCK_NONE")
-        categories = [
-            "HARM_CATEGORY_HARASSMENT",
-            "HARM_CATEGORY_HATE_SPEECH",
-            "HARM_CATEGORY_SEXUALLY_EXPLICIT",
-            "HARM_CATEGORY_DANGEROUS_CONTENT",
-        ]
-        safety_settings = [{"category": c, "threshold": threshold} for c in categories]
+        safety_settings = [{"category": c, "threshold": threshold} for c in _HARM_CATEGORIES]
         log.debug("Safety settings: %s", safety_settings)
 
         self._model_name = model_name
+        self._safety_settings = safety_settings
         self._client = genai.GenerativeModel(model_name, safety_settings=safety_settings)
+        self._model_cache: "OrderedDict[str, genai.GenerativeModel]" = OrderedDict()
+        self._model_cache_size = int(os.getenv("MENTORA_MODEL_CACHE_SIZE", "64"))
+        self._inflight: Dict[str, "asyncio.Future[Optional[str]]"] = {}
+        self._cache = ResponseCache() if os.getenv("MENTORA_RESPONSE_CACHE", "1") != "0" else None
         log.info("Gemini client initialized successfully.")
 
     @property
@@ -66,6 +128,25 @@ class Connection:
     def deployment_name(self) -> str:
         return self._model_name
 
+    def _get_model(self, system: Optional[str]):
+        """Return a GenerativeModel for this system instruction, reusing earlier instances."""
+        if not system:
+            return self._client
+        model = self._model_cache.get(system)
+        if model is None:
+            log.debug("Building GenerativeModel for new system instruction")
+            model = genai.GenerativeModel(
+                self._model_name,
+                system_instruction=system,
+                safety_settings=self._safety_settings
+            )
+            self._model_cache[system] = model
+            if len(self._model_cache) > self._model_cache_size:
+                self._model_cache.popitem(last=False)
+        else:
+            self._model_cache.move_to_end(system)
+        return model
+
     @staticmethod
     def _prepare_chat_history(messages: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], Optional[str]]:
         log.debug("Preparing chat history from %d messages", len(messages))
@@ -88,49 +169,46 @@ class Connection:
             "Building generation config: temperature=%.2f, max_tokens=%d, json_mode=%s",
             temperature, max_tokens, json_mode
         )
-        temperature = max(0.0, min(2.0, float(temperature)))
+        temperature = round(max(0.0, min(2.0, float(temperature))), 2)
         max_tokens = max(1, min(8192, int(max_tokens)))
-        cfg = {"temperature": temperature, "max_output_tokens": max_tokens}
-        if json_mode:
-            cfg["response_mime_type"] = "application/json"
-            cfg["response_schema"] = clean_schema({
-                "type": "object",
-                "properties": {
-                    "greeting": {"type": "string"},
-                    "topics": {"type": "array", "items": {"type": "string"}},
-                    "concluding_question": {"type": "string"},
-                    "suggestions": {"type": "array", "items": {"type": "string"}},
-                    "response": {"type": "string"},
-                    "reply": {"type": "string"}
-                }
-            })
-        log.debug("Final generation config: %s", cfg)
-        return genai.types.GenerationConfig(**cfg)
+        # GenerationConfig is copied by the SDK on every request, so one instance per shape is safe to share
+        return _cached_generation_config(temperature, max_tokens, bool(json_mode))
 
     @staticmethod
     def _clean_json_response(text: str) -> str:
-        if not text.strip():
-            return '{"response": "No response generated"}'
-
         text = text.strip()
-        if text.startswith("```json"):
-            text = text[7:]
-        if text.startswith("```"):
-            text = text[3:]
-        if text.endswith("```"):
-            text = text[:-3]
-
-        text = text.strip()
-        if not text.startswith("{"):
-            start_idx = text.find("{")
-            end_idx = text.rfind("}")
-            if start_idx != -1 and end_idx != -1 and end_idx > start_idx:
-                text = text[start_idx:end_idx + 1]
-            else:
-                return json.dumps({"response": text})
+        # JSON mode normally returns a bare object; only fenced or chatty replies need the regexes
+        if text.startswith("{") and text.endswith("}"):
+            return text
+        text = _FENCE_RE.sub("", text).strip()
+        candidate = extract_first_json_object(text)
+        if candidate:
+            return candidate
+        if "{" in text:  # unbalanced, e.g. truncated at max_tokens; let the caller's validation reject it
+            return text[text.index("{"):]
+        return orjson.dumps({"response": text or "No response generated"}).decode()
 
+    @classmethod
+    def validate_json_response(cls, text: str) -> Optional[str]:
+        """Cleaned JSON-mode reply, or None when it still does not parse (e.g. truncated at max_tokens)."""
+        text = cls._clean_json_response(text)
+        try:
+            orjson.loads(text)
+        except orjson.JSONDecodeError as e:
+            log.warning("JSON validation failed: %s. Raw text: %s", e, text)
+            return None
         return text
 
+    def _cache_key(self, system: Optional[str], history: List[Dict[str, Any]], temperature: float, max_tokens: int, json_mode: bool) -> str:
+        return make_key({
+            "model": self._model_name,
+            "system": system,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "json_mode": json_mode,
+            "history": history,
+        })
+
     async def generate_chat_completion(
         self,
         messages: List[Dict[str, Any]],
@@ -142,46 +220,109 @@ class Connection:
         history, system = self._prepare_chat_history(messages)
         cfg = self._generation_config(temperature, max_tokens, json_mode)
 
+        key = self._cache_key(system, history, temperature, max_tokens, json_mode)
+        if self._cache is not None:
+            cached = await self._cache.aget(key)
+            if cached is not None:
+                log.info("Cache hit for chat completion (key=%s)", key)
+                return cached
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            log.info("Joining in-flight chat completion (key=%s)", key)
+            text = await asyncio.shield(inflight)
+            if text is not None:
+                return text
+            return await self._complete(system, history, cfg, json_mode, key)
+
+        fut: "asyncio.Future[Optional[str]]" = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        text = None
         try:
-            if system:
-                model_with_system = genai.GenerativeModel(
-                    self._model_name,
-                    system_instruction=system,
-                    safety_settings=self._client._safety_settings
-                )
-                chat = model_with_system.start_chat(
-                    history=history[:-1] if history else [],
-                    enable_automatic_function_calling=False
-                )
-            else:
-                chat = self._client.start_chat(
-                    history=history[:-1] if history else [],
-                    enable_automatic_function_calling=False
-                )
-
-            last_message = history[-1]["parts"][0] if history else ""
-
-            log.debug("Sending to Gemini: last_user_message=%r", last_message)
-            result = await chat.send_message_async(
-                content=last_message,
+            text = await self._complete(system, history, cfg, json_mode, key)
+            return text
+        finally:
+            # A None result tells waiters the leader was cancelled and they should call the model themselves
+            fut.set_result(text)
+            self._inflight.pop(key, None)
+
+    async def _complete(self, system: Optional[str], history: List[Dict[str, Any]], cfg, json_mode: bool, key: str) -> str:
+        try:
+            model = self._get_model(system)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Sending to Gemini: last_message=%r", history[-1]["parts"][0] if history else "")
+            result = await model.generate_content_async(
+                contents=history or [{"role": "user", "parts": [""]}],
                 generation_config=cfg
             )
 
-            log.debug("Raw LLM result object: %s", result)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Raw LLM result object: %s", result)
             text = result.text or ""
 
             if json_mode and text:
-                text = self._clean_json_response(text)
-                try:
-                    json.loads(text)
-                except json.JSONDecodeError as e:
-                    log.warning("JSON validation failed: %s. Raw text: %s", e, text)
-                    text = json.dumps({"response": "I apologize, but I'm having trouble formatting my response properly. Could you please try again?"})
+                text = self.validate_json_response(text)
+                if text is None:
+                    return orjson.dumps({"response": FORMAT_ERROR_REPLY}).decode()
 
             log.info("Received LLM response length=%d", len(text))
+            if text and self._cache is not None:
+                self._cache.set(key, text)
             return text
         except Exception as e:
             log.error("Error during generate_chat_completion: %s", e, exc_info=True)
             if json_mode:
-                return json.dumps({"response": "Sorry, I had trouble generating a response."})
-            return "Sorry, I had trouble generating a response."
+                return orjson.dumps({"response": FALLBACK_REPLY}).decode()
+            return FALLBACK_REPLY
+
+
+    async def stream_chat_completion(
+        self,
+        messages: List[Dict[str, Any]],
+        temperature: float = 0.5,
+        max_tokens: int = 1024,
+        json_mode: bool = False
+    ) -> AsyncIterator[str]:
+        """Yield the completion text chunk by chunk as Gemini produces it."""
+        log.info("Streaming chat completion (messages=%d, json_mode=%s)", len(messages), json_mode)
+        history, system = self._prepare_chat_history(messages)
+        cfg = self._generation_config(temperature, max_tokens, json_mode)
+
+        key = self._cache_key(system, history, temperature, max_tokens, json_mode)
+        if self._cache is not None:
+            cached = await self._cache.aget(key)
+            if cached is not None:
+                log.info("Cache hit for streamed chat completion (key=%s)", key)
+                yield cached
+                return
+
+        chunks: List[str] = []
+        try:
+            model = self._get_model(system)
+            response = await model.generate_content_async(
+                contents=history or [{"role": "user", "parts": [""]}],
+                generation_config=cfg,
+                stream=True
+            )
+            async for chunk in response:
+                text = chunk.text or ""
+                if text:
+                    chunks.append(text)
+                    yield text
+        except Exception as e:
+            log.error("Error during stream_chat_completion: %s", e, exc_info=True)
+            if not chunks:
+                if json_mode:
+                    yield orjson.dumps({"response": FALLBACK_REPLY}).decode()
+                else:
+                    yield FALLBACK_REPLY
+            return
+
+        text = "".join(chunks)
+        log.info("Streamed LLM response length=%d", len(text))
+        if text and self._cache is not None:
+            if json_mode:
+                text = self.validate_json_response(text)
+                if text is None:
+                    return
+            self._cache.set(key, text)
@@ -1,15 +1,226 @@
 from __future__ import annotations
-import json, logging, os
-from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple
-import yaml
-from core.connection import Connection
+import asyncio, hashlib, logging, os, string, time
+from collections import OrderedDict
+from functools import lru_cache
+from importlib import resources
+from types import MappingProxyType
+from typing import TYPE_CHECKING, Any, AsyncIterator, Awaitable, Callable, Dict, List, Mapping, Optional, Sequence, Tuple
+import orjson, yaml
+try:
+    from yaml import CSafeLoader as _SafeLoader
+except ImportError:  # PyYAML built without libyaml
+    from yaml import SafeLoader as _SafeLoader
+from core.cache import SemanticCache, make_key
+from core.connection import FALLBACK_REPLY, FORMAT_ERROR_REPLY, Connection, extract_first_json_object
+if TYPE_CHECKING:  # importlib.resources.abc only exists on Python 3.11+
+    from importlib.resources.abc import Traversable
 
 log = logging.getLogger("mentora.engine")
-logging.basicConfig(
-    level=os.getenv("MENTORA_LOGLEVEL", "INFO"),
-    format="%(asctime)s [%(levelname)s] %(name)s: %(message)s"
+
+# Most recent messages sent verbatim (the original chat sent the last 6); once more have piled up, the oldest
+# HISTORY_STEP of them are folded into the rolling summary, so a summary call runs every other turn, not every turn
+HISTORY_WINDOW = max(2, int(os.getenv("MENTORA_HISTORY_WINDOW", "6")))
+HISTORY_STEP = HISTORY_WINDOW // 2
+# Most messages fed to one summarization call; a long backlog arriving at once is summarized from its tail
+SUMMARY_INPUT_MESSAGES = 40
+
+# Located through importlib.resources so the prompts also load from a zipped or wheel-only install
+PROMPTS_FILES = resources.files(__package__)
+
+def _prompts_digest(raw: bytes) -> str:
+    """Digest of the prompts.yaml bytes; tools/compile_prompts.py records the same one in prompts.json."""
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+def _read_prompts(files: Traversable) -> Any:
+    """Prefer the prompts.json compiled by tools/compile_prompts.py unless it is missing or was built from other YAML."""
+    raw = files.joinpath("prompts.yaml").read_bytes()
+    compiled = files.joinpath("prompts.json")
+    if compiled.is_file():
+        # Compared by content, not mtime: git checkouts and packaged installs do not keep file times
+        data = orjson.loads(compiled.read_bytes())
+        if isinstance(data, dict) and data.get("source_digest") == _prompts_digest(raw):
+            return data["prompts"]
+        log.warning("%s does not match prompts.yaml; run tools/compile_prompts.py", compiled.name)
+    # Bytes go straight to libyaml, which detects the encoding itself
+    return yaml.load(raw, Loader=_SafeLoader)
+
+def _load_prompts(files: Traversable) -> Mapping[str, Any]:
+    """Parse the prompts once per process; every engine shares the read-only result."""
+    log.debug("Loading prompts from %s", files)
+    try:
+        data = _read_prompts(files)
+        log.debug("Prompts loaded successfully")
+    except Exception as e:
+        log.warning("Failed to load prompts.yaml: %s", e)
+        data = {
+            "default_instructions": "You are a helpful AI mentor.",
+            "roles": {"default": "You are a general mentor."},
+            "tasks": {
+                "generate_intro_and_topics": "Return JSON with greeting, topics[], concluding_question, suggestions[].",
+                "chat": {
+                    "system_prompt": "{context_summary}\n{role_instruction}\n{default_instruction}\n{json_output_instruction}",
+                    "user_prompt_wrapper": "Summary: {summary}\nContinue the conversation based on recent messages.",
+                },
+                "summarize_conversation": "Summarize key points.",
+                "generate_topic_prompts": "Return a JSON array with 4 short questions for {topic}."
+            },
+            "shared_components": {
+                "json_output_format": "{\"response\":\"<markdown>\",\"suggestions\":[\"q1\",\"q2\",\"q3\"]}"
+            },
+        }
+    return MappingProxyType(data)
+
+# Resolved at import so constructing an engine never touches the filesystem
+_PROMPTS = _load_prompts(PROMPTS_FILES)
+
+# Stand-ins used when the model's reply is missing a field or cannot be parsed
+_FALLBACK_GREETING = "Hello! I'm your AI mentor, ready to guide you through your learning journey."
+_FALLBACK_TOPICS = ("Introduction", "Core Concepts", "Practical Applications", "Advanced Topics")
+_FALLBACK_QUESTION = "What would you like to explore first?"
+_FALLBACK_INTRO_SUGGESTIONS = ("What should I focus on?", "Can you explain the basics?", "Show me examples", "How does this work?")
+_FALLBACK_INTRO = (
+    _FALLBACK_GREETING + "\n\nLet's start exploring together!",
+    _FALLBACK_TOPICS,
+    ("What should I focus on first?", "Can you explain the basics?", "Show me an example", "How does this apply to real world?"),
 )
+_EMPTY_HISTORY_REPLY = "Please start the conversation with a message."
+_FALLBACK_CHAT_REPLY = "I'm having trouble formatting my response. Could you please rephrase your question?"
+_FALLBACK_CHAT_SUGGESTIONS = ("Can you explain more?", "What should I know next?", "Give me an example", "What's the next step?")
+_FALLBACK_TOPIC_PROMPTS = (
+    "What are the basics of {}?",
+    "Give me an example of {}",
+    "How to apply {} in practice?",
+    "What are common mistakes with {}?",
+)
+
+_FORMATTER = string.Formatter()
+
+def _fast_clean(items: Any, limit: Optional[int] = None) -> List[str]:
+    """Stringify and strip each item once, dropping blanks and stopping after `limit` kept items."""
+    out: List[str] = []
+    for item in items:
+        text = str(item).strip()
+        if text:
+            out.append(text)
+            if len(out) == limit:
+                break
+    return out
+
+def _compile_template(template: str) -> Callable[..., str]:
+    """
+    Parse a format string once and return a renderer that joins its literal pieces with the keyword
+    values; str.format re-walks the whole template on every call. Fields with a conversion, format
+    spec or attribute access keep using str.format.
+    """
+    parts = list(_FORMATTER.parse(template))
+    if any(spec or conversion or not field.isidentifier() for _, field, spec, conversion in parts if field is not None):
+        return template.format
+
+    def render(**values: Any) -> str:
+        out = []
+        for literal, field, _, _ in parts:
+            out.append(literal)
+            if field is not None:
+                out.append(str(values[field]))
+        return "".join(out)
+    return render
+
+def _partial_format(template: str, **static: Any) -> str:
+    """Substitute the `static` fields now; the result is a format string taking only the remaining ones."""
+    out = []
+    for literal, field, spec, conversion in _FORMATTER.parse(template):
+        out.append(literal.replace("{", "{{").replace("}", "}}"))
+        if field is None:
+            continue
+        if field in static:
+            value = _FORMATTER.format_field(_FORMATTER.convert_field(static[field], conversion), spec or "")
+            out.append(value.replace("{", "{{").replace("}", "}}"))
+        else:
+            out.append("{" + field + ("!" + conversion if conversion else "") + (":" + spec if spec else "") + "}")
+    return "".join(out)
+
+class _RoleTemplates:
+    """Compiled renderers for one role, resolved once so a render is an attribute load and a call."""
+    __slots__ = ("intro", "chat_system", "topic_prompts")
+
+    def __init__(self, intro: Callable[..., str], chat_system: Callable[..., str], topic_prompts: Callable[..., str]) -> None:
+        self.intro = intro
+        self.chat_system = chat_system
+        self.topic_prompts = topic_prompts
+
+class _JsonStringFieldStream:
+    """
+    Incrementally decodes the string value of one JSON key while the document is
+    still arriving, so reply text can be forwarded before the object closes.
+    """
+
+    def __init__(self, field: str) -> None:
+        self._key = orjson.dumps(field).decode()
+        self._buf = ""
+        self._pos = -1
+        self._scan_from = 0
+        self._done = False
+
+    def _find_value_start(self) -> int:
+        n = len(self._buf)
+        while True:
+            i = self._buf.find(self._key, self._scan_from)
+            if i == -1:
+                # The key may still be split across this chunk and the next one
+                self._scan_from = max(0, n - len(self._key) + 1)
+                return -1
+            self._scan_from = i
+            j = i + len(self._key)
+            while j < n and self._buf[j].isspace():
+                j += 1
+            is_key = j < n and self._buf[j] == ":"
+            if is_key:
+                j += 1
+                while j < n and self._buf[j].isspace():
+                    j += 1
+            if j >= n:
+                return -1  # wait for more input
+            if is_key and self._buf[j] == '"':
+                return j + 1
+            # The same text appeared as a value, or the key has a non-string value; keep looking
+            self._scan_from = i + 1
+
+    def feed(self, chunk: str) -> str:
+        if self._done:
+            return ""
+        self._buf += chunk
+        if self._pos < 0:
+            self._pos = self._find_value_start()
+            if self._pos < 0:
+                return ""
+
+        start, i, n = self._pos, self._pos, len(self._buf)
+        while i < n:
+            ch = self._buf[i]
+            if ch == '"':
+                self._done = True
+                break
+            if ch != "\\":
+                i += 1
+                continue
+            if i + 1 >= n:
+                break
+            if self._buf[i + 1] != "u":
+                i += 2
+                continue
+            # Keep surrogate pairs together so each decoded piece is valid text
+            width = 12 if i + 6 <= n and self._buf[i + 2:i + 4].lower() in ("d8", "d9", "da", "db") else 6
+            if i + width > n:
+                break
+            i += width
+        piece = self._buf[start:i]
+        # Only an unfinished escape sequence is carried over, so the buffer never grows with the reply
+        self._buf = "" if self._done else self._buf[i:]
+        self._pos = 0
+        try:
+            return orjson.loads('"' + piece + '"')
+        except orjson.JSONDecodeError:
+            return ""
 
 class MentorEngine:
     def __init__(self) -> None:
@@ -17,148 +228,191 @@ class MentorEngine:
         self.conn = Connection()
         self.llm = self.conn.client
         self.model_name = self.conn.deployment_name
-        self.prompts = self._load_yaml(Path(__file__).with_name("prompts.yaml"))
-        self.conversation_summaries: Dict[str, str] = {}
+        self.prompts = _PROMPTS
+        self._templates = self._prepare_templates()
+        self._default_templates = self._templates["default"]
+        # A learner's profile and topic rarely change between turns, so most turns reuse the rendered prompt
+        self._system_context = lru_cache(maxsize=int(os.getenv("MENTORA_SYSTEM_PROMPT_CACHE", "1024")))(self._format_system_context)
+        self._chat_user_tpl = _compile_template(self.prompts["tasks"]["chat"]["user_prompt_wrapper"])
+        self._summarize_instruction = self.prompts["tasks"]["summarize_conversation"]
+        self._results: "OrderedDict[str, Any]" = OrderedDict()
+        self._results_size = int(os.getenv("MENTORA_RESULT_CACHE_SIZE", "1024"))
+        self._result_locks: Dict[str, asyncio.Lock] = {}
+        self._summaries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._summaries_size = int(os.getenv("MENTORA_SUMMARY_CACHE", "2048"))
+        self._summaries_ttl = float(os.getenv("MENTORA_SUMMARY_TTL", "3600"))
+        self.topic_prompt_cache = SemanticCache(threshold=float(os.getenv("MENTORA_SEMANTIC_THRESHOLD", "0.95")))
         log.info("MentorEngine ready (model=%s)", self.model_name)
 
-    @staticmethod
-    def _load_yaml(path: Path) -> Dict[str, Any]:
-        log.debug("Loading prompts from %s", path)
+    def _prepare_templates(self) -> Dict[str, _RoleTemplates]:
+        """Per-role renderers with the role, default and output-format instructions already filled in."""
+        tasks = self.prompts["tasks"]
+        default_instruction = self.prompts.get("default_instructions", "")
+        json_output_instruction = self.prompts["shared_components"].get("json_output_format", "")
+        return {
+            role: _RoleTemplates(
+                intro=_compile_template(_partial_format(
+                    tasks["generate_intro_and_topics"],
+                    role_prompt=(role_prompt or "").strip(),
+                    default_behavior=(default_instruction or "").strip(),
+                )),
+                chat_system=_compile_template(_partial_format(
+                    tasks["chat"]["system_prompt"],
+                    role_instruction=role_prompt,
+                    default_instruction=default_instruction,
+                    json_output_instruction=json_output_instruction,
+                )),
+                topic_prompts=_compile_template(_partial_format(tasks["generate_topic_prompts"], role_prompt=role_prompt)),
+            )
+            for role, role_prompt in self.prompts["roles"].items()
+        }
+
+    def _templates_for(self, role: str) -> _RoleTemplates:
+        return self._templates.get(role, self._default_templates)
+
+    async def _cached(self, key: str, factory: Callable[[], Awaitable[Tuple[Any, bool]]]) -> Any:
+        """
+        Memoize a parsed generation result in a bounded LRU. `factory` returns (value, cacheable);
+        concurrent callers with the same key wait for the first one instead of generating again.
+        """
+        if key in self._results:
+            self._results.move_to_end(key)
+            return self._results[key]
+        lock = self._result_locks.setdefault(key, asyncio.Lock())
         try:
-            data = yaml.safe_load(path.read_text(encoding="utf-8"))
-            log.debug("Prompts loaded successfully")
-            return data
-        except Exception as e:
-            log.warning("Failed to load prompts.yaml: %s", e)
-            return {
-                "default_instructions": "You are a helpful AI mentor.",
-                "roles": {"default": "You are a general mentor."},
-                "tasks": {
-                    "generate_intro_and_topics": "Return JSON with greeting, topics[], concluding_question, suggestions[].",
-                    "chat": {
-                        "system_prompt": "{context_summary}\n{role_instruction}\n{default_instruction}\n{json_output_instruction}",
-                        "user_prompt_wrapper": "Summary: {summary}\nContinue the conversation based on recent messages.",
-                    },
-                    "summarize_conversation": "Summarize key points.",
-                    "generate_topic_prompts": "Return a JSON array with 4 short questions for {topic}."
-                },
-                "shared_components": {
-                    "json_output_format": "{\"response\":\"<markdown>\",\"suggestions\":[\"q1\",\"q2\",\"q3\"]}"
-                },
-            }
+            async with lock:
+                if key in self._results:
+                    return self._results[key]
+                value, cacheable = await factory()
+                if cacheable:
+                    self._results[key] = value
+                    while len(self._results) > self._results_size:
+                        self._results.popitem(last=False)
+                return value
+        finally:
+            if not lock.locked() and self._result_locks.get(key) is lock:
+                del self._result_locks[key]
 
     @staticmethod
-    def _sanitize_text(s: Optional[str]) -> str:
-        return (s or "").strip()
+    def _parse_json_strict(response_text: str) -> Any:
+        """One orjson parse; raises orjson.JSONDecodeError unless the text is plain JSON, as json_mode replies are."""
+        return orjson.loads(response_text)
 
     @staticmethod
-    def _safe_json_parse(response_text: str) -> Dict[str, Any]:
-        """Safely parse JSON response with multiple fallback attempts"""
+    def _parse_json_lenient(response_text: str) -> Dict[str, Any]:
+        """Recover the first JSON object from text wrapped in prose, or an error dict when there is none."""
         if not response_text.strip():
             return {}
-        
-        try:
-            # First attempt: direct parsing
-            return json.loads(response_text)
-        except json.JSONDecodeError:
-            pass
-        
-        try:
-            # Second attempt: look for nested JSON in "response" field
-            data = json.loads(response_text)
-            if isinstance(data, dict) and "response" in data:
-                try:
-                    return json.loads(data["response"])
-                except (json.JSONDecodeError, TypeError):
-                    return data
-            return data
-        except json.JSONDecodeError:
-            pass
-        
-        # Third attempt: extract JSON-like content using regex
-        import re
-        json_match = re.search(r'\{.*\}', response_text, re.DOTALL)
-        if json_match:
+        candidate = extract_first_json_object(response_text)
+        if candidate:
             try:
-                return json.loads(json_match.group(0))
-            except json.JSONDecodeError:
+                return orjson.loads(candidate)
+            except orjson.JSONDecodeError:
                 pass
-        
-        # Final fallback
         log.warning("Could not parse JSON from response: %s", response_text[:200])
         return {"error": "Failed to parse response", "raw_response": response_text}
 
-    async def _get_conversation_summary(self, chat_title: str, chat_history: List[Dict[str, Any]]) -> str:
-        log.debug("Getting conversation summary for title=%s, messages=%d", chat_title, len(chat_history))
-        if len(chat_history) < 10:
-            return self.conversation_summaries.get(chat_title, "")
+    @classmethod
+    def _safe_json_parse(cls, response_text: str) -> Dict[str, Any]:
+        try:
+            return cls._parse_json_strict(response_text)
+        except orjson.JSONDecodeError:
+            return cls._parse_json_lenient(response_text)
+
+    async def compact_history(self, chat_history: List[Dict[str, Any]], *, summary: str = "", covered: int = 0) -> Tuple[str, int]:
+        """
+        Fold messages that have slid out of the recent window into the rolling summary.
+        Returns the summary and how many leading messages it covers; only chat_history[covered:]
+        needs to be sent to the model.
+        """
+        if covered > len(chat_history):  # history was reset or truncated by the client
+            summary, covered = "", 0
+        if len(chat_history) - covered <= HISTORY_WINDOW:
+            return summary, covered
+        cut = len(chat_history) - (HISTORY_WINDOW - HISTORY_STEP)
+        folded = chat_history[max(covered, cut - SUMMARY_INPUT_MESSAGES):cut]
+        # A retried turn folds the same messages onto the same summary; reuse the earlier result
+        key = make_key({"summary": summary, "messages": [(m.get("role"), m.get("content")) for m in folded]})
+        hit = self._summaries.get(key)
+        if hit is not None:
+            if hit[0] > time.monotonic():
+                self._summaries.move_to_end(key)
+                return hit[1], cut
+            del self._summaries[key]
+        log.debug("Compacting messages %d..%d into summary", covered, cut)
+        content = self._summarize_instruction
+        if summary:
+            content += "\n\nSummary so far:\n" + summary
+        content += "\n\n" + "\n".join(f"{m.get('role') or 'user'}: {m.get('content') or ''}" for m in folded)
         try:
-            payload = [{
-                "role": "user",
-                "content": self.prompts["tasks"]["summarize_conversation"] + "\n\n" + json.dumps(chat_history)
-            }]
-            resp = await self.conn.generate_chat_completion(messages=payload, temperature=0.3)
-            summary = self._sanitize_text(resp)
-            if summary:
-                self.conversation_summaries[chat_title] = summary
-            log.debug("Generated summary: %s", summary)
-            return summary
+            resp = await self.conn.generate_chat_completion(messages=[{"role": "user", "content": content}], temperature=0.3)
         except Exception as e:
             log.warning("Failed to generate summary: %s", e)
-            return self.conversation_summaries.get(chat_title, "")
+            return summary, covered
+        new_summary = (resp or "").strip()
+        if not new_summary or new_summary == FALLBACK_REPLY:
+            return summary, covered
+        self._summaries[key] = (time.monotonic() + self._summaries_ttl, new_summary)
+        while len(self._summaries) > self._summaries_size:
+            self._summaries.popitem(last=False)
+        return new_summary, cut
 
     async def generate_intro_and_topics(
         self,
         *,
         context_description: str,
         extra_instructions: Optional[str] = None,
-        role: Optional[str] = None
+        role: Optional[str] = None,
+        max_tokens: int = 2048
     ) -> Tuple[str, List[str], List[str]]:
         log.info("Generating intro and topics for role=%s", role or "default")
         role = role or "default"
-        
-        default_behavior = self.prompts.get("default_instructions", "")
-        role_prompt = self.prompts["roles"].get(role, self.prompts["roles"]["default"])
-        prompt_template = self.prompts["tasks"]["generate_intro_and_topics"]
-
-        prompt_content = prompt_template.format(
-            context_description=self._sanitize_text(context_description),
-            role_prompt=self._sanitize_text(role_prompt),
-            default_behavior=self._sanitize_text(default_behavior),
-            extra_instructions=self._sanitize_text(extra_instructions) or "",
+        key = make_key({"task": "intro", "role": role, "context": context_description, "extra": extra_instructions, "max_tokens": max_tokens})
+        intro, topics, suggestions = await self._cached(
+            key, lambda: self._generate_intro_and_topics(role, context_description, extra_instructions, max_tokens)
         )
+        return intro, list(topics), list(suggestions)
 
-        log.debug("Prompt content for intro/topics: %s", prompt_content)
+    async def _generate_intro_and_topics(
+        self, role: str, context_description: str, extra_instructions: Optional[str], max_tokens: int
+    ) -> Tuple[Tuple[str, Tuple[str, ...], Tuple[str, ...]], bool]:
+        prompt_content = self._templates_for(role).intro(
+            context_description=(context_description or "").strip(),
+            extra_instructions=(extra_instructions or "").strip(),
+        )
+
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Prompt content for intro/topics: %s", prompt_content)
         messages = [{"role": "user", "content": prompt_content}]
         
         llm_response = await self.conn.generate_chat_completion(
             messages=messages, 
             temperature=0.5, 
             json_mode=True,
-            max_tokens=2048
+            max_tokens=max_tokens
         )
-        log.debug("Raw LLM response: %s", llm_response)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Raw LLM response: %s", llm_response)
 
         parsed = self._safe_json_parse(llm_response)
         
         if "error" in parsed:
             log.warning("JSON parsing failed, using fallback")
-            return self._fallback_intro()
+            return self._fallback_intro(), False
 
-        greeting = self._sanitize_text(parsed.get("greeting", ""))
-        topics = [self._sanitize_text(str(t)) for t in parsed.get("topics", []) if str(t).strip()]
-        question = self._sanitize_text(parsed.get("concluding_question", ""))
-        suggestions = [self._sanitize_text(str(s)) for s in parsed.get("suggestions", []) if str(s).strip()]
+        greeting = (parsed.get("greeting") or "").strip()
+        topics = _fast_clean(parsed.get("topics", []))
+        question = (parsed.get("concluding_question") or "").strip()
+        suggestions = _fast_clean(parsed.get("suggestions", []))
+
+        # Only cache replies the model actually filled in, not ones padded with the defaults below
+        complete = bool(greeting and topics)
 
         # Ensure we have at least some content
-        if not greeting:
-            greeting = "Hello! I'm your AI mentor, ready to guide you through your learning journey."
-        if not topics:
-            topics = ["Introduction", "Core Concepts", "Practical Applications", "Advanced Topics"]
-        if not question:
-            question = "What would you like to explore first?"
-        if not suggestions:
-            suggestions = ["What should I focus on?", "Can you explain the basics?", "Show me examples", "How does this work?"]
+        greeting = greeting or _FALLBACK_GREETING
+        topics = topics or _FALLBACK_TOPICS
+        question = question or _FALLBACK_QUESTION
+        suggestions = suggestions or _FALLBACK_INTRO_SUGGESTIONS
 
         log.info("Intro generated: greeting=%s, topics=%d, suggestions=%d", greeting[:50], len(topics), len(suggestions))
         
@@ -166,80 +420,74 @@ class MentorEngine:
             f"{greeting}\n\nHere are the topics we'll explore:\n- " + "\n- ".join(topics) + f"\n\n{question}"
             if topics else f"{greeting}\n\n{question}"
         )
-        return intro, topics, suggestions
+        return (intro, tuple(topics), tuple(suggestions)), complete
 
-    def _fallback_intro(self) -> Tuple[str, List[str], List[str]]:
+    def _fallback_intro(self) -> Tuple[str, Tuple[str, ...], Tuple[str, ...]]:
         log.debug("Using fallback intro")
-        return (
-            "Hello! I'm your AI mentor, ready to guide you through your learning journey.\n\nLet's start exploring together!",
-            ["Introduction", "Core Concepts", "Practical Applications", "Advanced Topics"],
-            ["What should I focus on first?", "Can you explain the basics?", "Show me an example", "How does this apply to real world?"],
-        )
+        return _FALLBACK_INTRO
 
-    async def chat(
+    def _build_system_context(
         self,
         *,
-        chat_history: List[Dict[str, Any]],
-        user_id: str,
-        chat_title: str,
+        role: str,
         learning_goal: Optional[str],
         skills: List[str],
         difficulty: str,
-        role: str,
         mentor_topics: Optional[List[str]] = None,
         current_topic: Optional[str] = None,
         completed_topics: Optional[List[str]] = None
-    ) -> Tuple[str, List[str]]:
-        log.info("Chat request: user=%s, title=%s, messages=%d", user_id, chat_title, len(chat_history))
-        if not chat_history:
-            log.warning("Empty chat history")
-            return "Please start the conversation with a message.", []
-
-        summary = await self._get_conversation_summary(chat_title, chat_history)
-
-        context_lines = [f"Role: {role}"]
-        if learning_goal:
-            context_lines.append(f"Learning Goal: {learning_goal}")
-        if skills:
-            context_lines.append(f"Skills: {', '.join(skills)}")
-        context_lines.append(f"Difficulty: {difficulty}")
-        if mentor_topics:
-            context_lines.append(f"Topics: {', '.join(mentor_topics)}")
-        if current_topic:
-            context_lines.append(f"Current Topic: {current_topic}")
-        if completed_topics:
-            context_lines.append(f"Completed Topics: {', '.join(completed_topics)}")
-
-        role_instruction = self.prompts["roles"].get(role, self.prompts["roles"]["default"])
-        default_instruction = self.prompts.get("default_instructions", "")
-        json_output_instruction = self.prompts["shared_components"].get("json_output_format", "")
-        
-        system_prompt = self.prompts["tasks"]["chat"]["system_prompt"].format(
-            context_summary="\n".join(context_lines),
-            role_instruction=role_instruction,
-            default_instruction=default_instruction,
-            json_output_instruction=json_output_instruction,
+    ) -> str:
+        return self._system_context(
+            role, learning_goal, tuple(skills or ()), difficulty,
+            tuple(mentor_topics or ()), current_topic, tuple(completed_topics or ()),
+        )
+
+    def _format_system_context(
+        self,
+        role: str,
+        learning_goal: Optional[str],
+        skills: Tuple[str, ...],
+        difficulty: str,
+        mentor_topics: Tuple[str, ...],
+        current_topic: Optional[str],
+        completed_topics: Tuple[str, ...],
+    ) -> str:
+        pairs = (
+            ("Role", role),
+            ("Learning Goal", learning_goal),
+            ("Skills", ", ".join(skills) if skills else None),
+            ("Difficulty", difficulty),
+            ("Topics", ", ".join(mentor_topics) if mentor_topics else None),
+            ("Current Topic", current_topic),
+            ("Completed Topics", ", ".join(completed_topics) if completed_topics else None),
         )
+        context_summary = "\n".join(f"{label}: {value}" for label, value in pairs if value)
+        return self._templates_for(role).chat_system(context_summary=context_summary)
+
+    def _build_chat_messages(
+        self,
+        *,
+        chat_history: List[Dict[str, Any]],
+        summary: str = "",
+        **context: Any
+    ) -> List[Dict[str, Any]]:
+        system_prompt = self._build_system_context(**context)
         
-        user_prompt = self.prompts["tasks"]["chat"]["user_prompt_wrapper"].format(
+        user_prompt = self._chat_user_tpl(
             summary=summary or "(no prior summary)"
         )
 
-        messages = [
-            {"role": "system", "content": system_prompt},
-            *chat_history[-6:],  # Only use last 6 messages to avoid token limits
-            {"role": "user", "content": user_prompt}
-        ]
-
-        log.debug("System prompt: %s", system_prompt)
-        llm_response = await self.conn.generate_chat_completion(
-            messages=messages, 
-            temperature=0.5, 
-            json_mode=True,
-            max_tokens=1500
-        )
-        log.debug("Raw LLM chat response: %s", llm_response)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("System prompt: %s", system_prompt)
+        # Callers pass the window left after compact_history, so the slice copy is normally skipped; a turn
+        # answered while its compaction is still running may carry one extra step
+        limit = HISTORY_WINDOW + HISTORY_STEP
+        messages = [{"role": "system", "content": system_prompt}]
+        messages.extend(chat_history if len(chat_history) <= limit else chat_history[-limit:])
+        messages.append({"role": "user", "content": user_prompt})
+        return messages
 
+    def _parse_chat_reply(self, llm_response: str) -> Tuple[str, List[str]]:
         parsed = self._safe_json_parse(llm_response)
         
         # Extract response and suggestions with multiple fallback strategies
@@ -249,9 +497,9 @@ class MentorEngine:
         if "error" not in parsed:
             # Try different response field names
             reply = (
-                self._sanitize_text(parsed.get("response", "")) or
-                self._sanitize_text(parsed.get("reply", "")) or
-                self._sanitize_text(parsed.get("content", ""))
+                (parsed.get("response") or "").strip() or
+                (parsed.get("reply") or "").strip() or
+                (parsed.get("content") or "").strip()
             )
             
             # Try to get suggestions
@@ -260,54 +508,146 @@ class MentorEngine:
                 parsed.get("follow_up", []) or
                 parsed.get("prompts", [])
             )
-            suggestions = [self._sanitize_text(str(s)) for s in suggestions_raw if str(s).strip()][:4]
+            suggestions = _fast_clean(suggestions_raw, 4)
         
         # Fallbacks if parsing failed
         if not reply:
             if "error" in parsed and "raw_response" in parsed:
                 reply = parsed["raw_response"]
             else:
-                reply = "I'm having trouble formatting my response. Could you please rephrase your question?"
-        
+                reply = _FALLBACK_CHAT_REPLY
+
         if not suggestions:
-            suggestions = [
-                "Can you explain more?",
-                "What should I know next?",
-                "Give me an example",
-                "What's the next step?"
-            ]
+            suggestions = list(_FALLBACK_CHAT_SUGGESTIONS)
 
         log.info("Reply generated: %s (suggestions=%d)", reply[:80], len(suggestions))
-        return reply, suggestions[:4]  # Ensure max 4 suggestions
+        return reply, suggestions
+
+    async def chat(
+        self,
+        *,
+        chat_history: List[Dict[str, Any]],
+        user_id: str,
+        chat_title: str,
+        summary: str = "",
+        learning_goal: Optional[str],
+        skills: List[str],
+        difficulty: str,
+        role: str,
+        mentor_topics: Optional[List[str]] = None,
+        current_topic: Optional[str] = None,
+        completed_topics: Optional[List[str]] = None,
+        max_tokens: int = 1500
+    ) -> Tuple[str, List[str]]:
+        log.info("Chat request: user=%s, title=%s, messages=%d", user_id, chat_title, len(chat_history))
+        if not chat_history:
+            log.warning("Empty chat history")
+            return _EMPTY_HISTORY_REPLY, []
+
+        messages = self._build_chat_messages(
+            chat_history=chat_history, summary=summary, role=role, learning_goal=learning_goal, skills=skills,
+            difficulty=difficulty, mentor_topics=mentor_topics, current_topic=current_topic, completed_topics=completed_topics
+        )
+        llm_response = await self.conn.generate_chat_completion(
+            messages=messages, 
+            temperature=0.5, 
+            json_mode=True,
+            max_tokens=max_tokens
+        )
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Raw LLM chat response: %s", llm_response)
+        return self._parse_chat_reply(llm_response)
+
+    async def stream_chat(
+        self,
+        *,
+        chat_history: List[Dict[str, Any]],
+        user_id: str,
+        chat_title: str,
+        summary: str = "",
+        learning_goal: Optional[str],
+        skills: List[str],
+        difficulty: str,
+        role: str,
+        mentor_topics: Optional[List[str]] = None,
+        current_topic: Optional[str] = None,
+        completed_topics: Optional[List[str]] = None,
+        max_tokens: int = 1500
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Streaming variant of `chat`. Yields {"type": "delta", "text": ...} events as the
+        reply text arrives, then a final {"type": "done", "reply": ..., "suggestions": [...]}.
+        """
+        log.info("Streaming chat request: user=%s, title=%s, messages=%d", user_id, chat_title, len(chat_history))
+        if not chat_history:
+            log.warning("Empty chat history")
+            reply = _EMPTY_HISTORY_REPLY
+            yield {"type": "delta", "text": reply}
+            yield {"type": "done", "reply": reply, "suggestions": []}
+            return
+
+        messages = self._build_chat_messages(
+            chat_history=chat_history, summary=summary, role=role, learning_goal=learning_goal, skills=skills,
+            difficulty=difficulty, mentor_topics=mentor_topics, current_topic=current_topic, completed_topics=completed_topics
+        )
+        field = _JsonStringFieldStream("response")
+        chunks, streamed = [], False
+        async for chunk in self.conn.stream_chat_completion(
+            messages=messages,
+            temperature=0.5,
+            json_mode=True,
+            max_tokens=max_tokens
+        ):
+            chunks.append(chunk)
+            delta = field.feed(chunk)
+            if delta:
+                streamed = True
+                yield {"type": "delta", "text": delta}
+
+        llm_response = "".join(chunks)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Raw LLM streamed chat response: %s", llm_response)
+        if llm_response:
+            # Same check generate_chat_completion applies, so a truncated stream ends like a truncated /chat reply
+            llm_response = self.conn.validate_json_response(llm_response) or orjson.dumps({"response": FORMAT_ERROR_REPLY}).decode()
+        reply, suggestions = self._parse_chat_reply(llm_response)
+        if not streamed:
+            yield {"type": "delta", "text": reply}
+        yield {"type": "done", "reply": reply, "suggestions": suggestions}
 
     async def generate_topic_prompts(
         self,
         topic: str,
         *,
         context_description: str = "",
-        role: Optional[str] = None
+        role: Optional[str] = None,
+        max_tokens: int = 1024
     ) -> List[str]:
         log.info("Generating topic prompts for: %s", topic)
         role = role or "default"
-        role_prompt = self.prompts["roles"].get(role, self.prompts["roles"]["default"])
-        tmpl = self.prompts["tasks"]["generate_topic_prompts"]
-        
-        prompt = tmpl.format(
-            topic=topic, 
-            role_prompt=role_prompt, 
-            context_description=context_description
-        )
+        key = make_key({"task": "topic_prompts", "role": role, "topic": topic, "context": context_description, "max_tokens": max_tokens})
+        return list(await self._cached(key, lambda: self._generate_topic_prompts(topic, role, context_description, max_tokens)))
+
+    async def _generate_topic_prompts(self, topic: str, role: str, context_description: str, max_tokens: int) -> Tuple[Tuple[str, ...], bool]:
+        namespace = make_key({"role": role, "context": context_description})
+        cached = self.topic_prompt_cache.get(namespace, topic)
+        if cached is not None:
+            log.info("Using semantically cached topic prompts for %s", topic)
+            return cached, True
+        prompt = self._templates_for(role).topic_prompts(topic=topic, context_description=context_description)
 
-        log.debug("Topic prompt content: %s", prompt)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Topic prompt content: %s", prompt)
         messages = [{"role": "user", "content": prompt}]
         
         resp = await self.conn.generate_chat_completion(
             messages=messages, 
             temperature=0.5, 
             json_mode=True,
-            max_tokens=1024
+            max_tokens=max_tokens
         )
-        log.debug("Raw topic prompts response: %s", resp)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Raw topic prompts response: %s", resp)
 
         parsed = self._safe_json_parse(resp)
         
@@ -320,17 +660,32 @@ class MentorEngine:
                 parsed.get("questions", []) or
                 parsed.get("suggestions", [])
             )
-            prompts = [self._sanitize_text(str(s)) for s in prompts_raw if str(s).strip()]
+            prompts = _fast_clean(prompts_raw, 4)
 
         # Fallback prompts if parsing failed
         if not prompts:
-            prompts = [
-                f"What are the basics of {topic}?",
-                f"Give me an example of {topic}",
-                f"How to apply {topic} in practice?",
-                f"What are common mistakes with {topic}?",
-            ]
             log.info("Using fallback topic prompts for %s", topic)
-        
+            return tuple(t.format(topic) for t in _FALLBACK_TOPIC_PROMPTS), False
+        prompts = tuple(prompts)
+        self.topic_prompt_cache.set(namespace, topic, prompts)
         log.info("Generated %d topic prompts", len(prompts))
-        return prompts[:4]  # Ensure max 4 prompts
\ No newline at end of file
+        return prompts, True
+
+    async def generate_topic_prompts_many(
+        self,
+        topics: Sequence[str],
+        *,
+        context_description: str = "",
+        role: Optional[str] = None,
+        max_tokens: int = 1024
+    ) -> Dict[str, List[str]]:
+        """
+        Topic prompts for several topics at once. The calls run concurrently, so the batch costs
+        about one model round-trip; repeated topics are generated once.
+        """
+        unique = list(dict.fromkeys(topics))
+        results = await asyncio.gather(*(
+            self.generate_topic_prompts(t, context_description=context_description, role=role, max_tokens=max_tokens)
+            for t in unique
+        ))
+        return dict(zip(unique, results))
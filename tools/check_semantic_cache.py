@@ -0,0 +1,23 @@
+"""Regression check for SemanticCache: topics that differ only in symbols or version numbers must not share entries."""
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from core.cache import SemanticCache  # noqa: E402
+
+MUST_MISS = [
+    ("C", "C++"), ("C++", "C#"), ("C", "C#"), ("F", "F#"), ("Intro to C++", "Intro to C#"),
+    ("Intro to C", "Intro to C++"), ("Python 2", "Python 3"), ("Java to Python", "Python to Java"),
+]
+MUST_HIT = [("C++", "c++"), ("Intro to C#", "intro  to c#"), ("Python basics", "Python basics.")]
+
+if __name__ == "__main__":
+    failures = []
+    for stored, asked, expect in [(a, b, False) for a, b in MUST_MISS] + [(a, b, True) for a, b in MUST_HIT]:
+        for x, y in ((stored, asked), (asked, stored)):
+            cache = SemanticCache()
+            cache.set("ns", x, x)
+            if (cache.get("ns", y) == x) != expect:
+                failures.append(f"{y!r} after {x!r}: expected {'hit' if expect else 'miss'}")
+    print("\n".join(failures) or "ok")
+    sys.exit(1 if failures else 0)
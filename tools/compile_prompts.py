@@ -0,0 +1,15 @@
+"""Regenerate core/engine/prompts.json from prompts.yaml. Run after editing the YAML."""
+import hashlib
+import json
+from pathlib import Path
+import yaml
+
+SRC = Path(__file__).resolve().parent.parent / "core" / "engine" / "prompts.yaml"
+
+if __name__ == "__main__":
+    raw = SRC.read_bytes()
+    # The engine ignores the JSON unless this digest matches the YAML it is loading (see _prompts_digest)
+    data = {"source_digest": hashlib.blake2b(raw, digest_size=16).hexdigest(), "prompts": yaml.safe_load(raw)}
+    dst = SRC.with_suffix(".json")
+    dst.write_text(json.dumps(data, ensure_ascii=False, indent=1), encoding="utf-8")
+    print(f"Wrote {dst}")
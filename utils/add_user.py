@@ -1,4 +1,4 @@
-from handle_user import create_user, get_user
+from handle_user import create_users_bulk, get_user
 
 # Sample multiple users
 users_data = [
@@ -31,19 +31,11 @@ users_data = [
     }
 ]
 
-# Create multiple users
-for u in users_data:
-    create_user(
-        user_id=u["user_id"],
-        name=u["name"],
-        password=u["password"],
-        email=u["email"],
-        firm=u["firm"],
-        unit=u["unit"],
-        location=u["location"],
-    )
+# Create all users in one transaction
+create_users_bulk(users_data)
 
-    # Confirm creation
+# Confirm creation
+for u in users_data:
     user = get_user(u["user_id"])
     print("\nInserted user:", user)
     print("You can now log in with:")
@@ -1,19 +1,60 @@
 from __future__ import annotations
-import datetime as _dt, json, sqlite3
+import os, queue, sqlite3, time
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+import orjson
 
 _DB_DIR = Path(__file__).resolve().parent.parent / "data"
 _DB_DIR.mkdir(parents=True, exist_ok=True)
 _DB_PATH = _DB_DIR / "user_history.db"
+_POOL_SIZE = int(os.getenv("MENTORA_DB_POOL_SIZE", "8"))
+# LIFO so the most recently used connection, whose page cache is warm, is handed out first
+_pool: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue(maxsize=_POOL_SIZE)
+
+_now_second: Tuple[int, str] = (-1, "")
+
+def _utc_now_iso() -> str:
+    """UTC timestamp in the datetime.isoformat() layout, always with microseconds so values sort as text."""
+    global _now_second
+    t = time.time()
+    sec = int(t)
+    cached_sec, prefix = _now_second
+    if sec != cached_sec:  # only the first write in each second pays for strftime
+        prefix = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(sec))
+        _now_second = (sec, prefix)
+    return f"{prefix}.{int((t - sec) * 1_000_000):06d}"
 
 def _connect():
-    conn = sqlite3.connect(_DB_PATH, check_same_thread=False)
+    conn = sqlite3.connect(_DB_PATH, check_same_thread=False, cached_statements=256)
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA cache_size=-20000")  # KiB, i.e. ~20 MB of page cache per connection
     return conn
 
+@contextmanager
+def borrow() -> Iterator[sqlite3.Connection]:
+    """Check a connection out of the pool (opening one if it is empty) for one transaction."""
+    try:
+        conn = _pool.get_nowait()
+    except queue.Empty:
+        conn = _connect()
+    try:
+        with conn:
+            yield conn
+    finally:
+        try:
+            _pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
 def init_db() -> None:
-    with _connect() as conn:
+    while not _pool.full():
+        _pool.put_nowait(_connect())
+    with borrow() as conn:
         c = conn.cursor()
         c.execute(
             """
@@ -25,10 +66,26 @@ def init_db() -> None:
                 current_topic TEXT,
                 completed_topics TEXT,
                 updated_at TEXT NOT NULL,
+                summary TEXT,
+                summary_upto INTEGER NOT NULL DEFAULT 0,
                 PRIMARY KEY(user_id, title)
             )
             """
         )
+        c.execute(
+            """
+            CREATE TABLE IF NOT EXISTS chat_messages (
+                user_id TEXT NOT NULL,
+                title TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                ts REAL,
+                audio_url TEXT,
+                PRIMARY KEY(user_id, title, seq)
+            )
+            """
+        )
         c.execute(
             """
             CREATE TABLE IF NOT EXISTS user_preferences (
@@ -41,60 +98,132 @@ def init_db() -> None:
             )
             """
         )
+        # Serves get_chats straight from the index: filtered by user, already newest-first, title included
+        c.execute("CREATE INDEX IF NOT EXISTS idx_chats_user_updated ON chats(user_id, updated_at DESC, title)")
+        _migrate_summary_columns(conn)
+        _migrate_messages_json(conn)
         conn.commit()
 
-def save_chat(*, user_id: str, title: str, messages_json: str, mentor_topics: List[str], current_topic: Optional[str], completed_topics: List[str]) -> None:
-    with _connect() as conn:
+_INSERT_MESSAGE_SQL = "INSERT OR REPLACE INTO chat_messages (user_id, title, seq, role, content, ts, audio_url) VALUES (?, ?, ?, ?, ?, ?, ?)"
+
+def _message_rows(user_id: str, title: str, start_seq: int, messages: Iterable[Dict[str, Any]]) -> List[Tuple[Any, ...]]:
+    return [
+        (user_id, title, seq, m.get("role") or "", m.get("content") or "", m.get("timestamp"), m.get("audio_url"))
+        for seq, m in enumerate(messages, start=start_seq)
+    ]
+
+def _migrate_summary_columns(conn: sqlite3.Connection) -> None:
+    """Add the rolling-summary columns to chats tables created before they existed."""
+    columns = {r["name"] for r in conn.execute("PRAGMA table_info(chats)")}
+    if "summary" not in columns:
+        conn.execute("ALTER TABLE chats ADD COLUMN summary TEXT")
+    if "summary_upto" not in columns:
+        conn.execute("ALTER TABLE chats ADD COLUMN summary_upto INTEGER NOT NULL DEFAULT 0")
+
+def _migrate_messages_json(conn: sqlite3.Connection) -> None:
+    """Move histories still stored as a messages_json blob into chat_messages rows."""
+    rows = conn.execute("SELECT user_id, title, messages_json FROM chats WHERE messages_json NOT IN ('', '[]')").fetchall()
+    for r in rows:
+        try:
+            messages = orjson.loads(r["messages_json"])
+        except Exception:
+            messages = []
+        conn.execute("DELETE FROM chat_messages WHERE user_id=? AND title=?", (r["user_id"], r["title"]))
+        conn.executemany(_INSERT_MESSAGE_SQL, _message_rows(r["user_id"], r["title"], 0, [m for m in messages if isinstance(m, dict)]))
+        conn.execute("UPDATE chats SET messages_json='[]' WHERE user_id=? AND title=?", (r["user_id"], r["title"]))
+
+def save_chat(*, user_id: str, title: str, mentor_topics: List[str], current_topic: Optional[str], completed_topics: List[str], new_messages: Sequence[Dict[str, Any]] = (), start_seq: int = 0, summary: Optional[str] = None, summary_upto: int = 0) -> None:
+    """
+    Upsert the chat's topic state and write `new_messages` at positions `start_seq`, `start_seq + 1`, ...
+    Any previously stored messages from `start_seq` onwards are replaced; earlier ones are left untouched.
+    `summary` covers the first `summary_upto` messages of the chat; a stored summary that covers more of
+    the messages being kept (written meanwhile by save_chat_summary) is left in place.
+    """
+    with borrow() as conn:
         conn.execute(
             """
-            INSERT INTO chats (user_id, title, messages_json, mentor_topics, current_topic, completed_topics, updated_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
+            INSERT INTO chats (user_id, title, messages_json, mentor_topics, current_topic, completed_topics, updated_at, summary, summary_upto)
+            VALUES (?, ?, '[]', ?, ?, ?, ?, ?, ?)
             ON CONFLICT(user_id, title) DO UPDATE SET
-              messages_json=excluded.messages_json,
               mentor_topics=excluded.mentor_topics,
               current_topic=excluded.current_topic,
               completed_topics=excluded.completed_topics,
-              updated_at=excluded.updated_at
+              updated_at=excluded.updated_at,
+              summary=CASE WHEN chats.summary_upto > excluded.summary_upto AND chats.summary_upto <= ? THEN chats.summary ELSE excluded.summary END,
+              summary_upto=CASE WHEN chats.summary_upto > excluded.summary_upto AND chats.summary_upto <= ? THEN chats.summary_upto ELSE excluded.summary_upto END
             """,
             (
                 user_id,
                 title,
-                messages_json,
-                json.dumps(mentor_topics or []),
+                orjson.dumps(mentor_topics or []).decode(),
                 current_topic,
-                json.dumps(completed_topics or []),
-                _dt.datetime.utcnow().isoformat(),
+                orjson.dumps(completed_topics or []).decode(),
+                _utc_now_iso(),
+                summary,
+                summary_upto,
+                start_seq + len(new_messages),
+                start_seq + len(new_messages),
             ),
         )
+        conn.execute("DELETE FROM chat_messages WHERE user_id=? AND title=? AND seq>=?", (user_id, title, start_seq))
+        if new_messages:
+            conn.executemany(_INSERT_MESSAGE_SQL, _message_rows(user_id, title, start_seq, new_messages))
+        conn.commit()
+
+def save_chat_summary(user_id: str, title: str, summary: str, summary_upto: int) -> None:
+    """Store a rolling summary computed after its turn was saved, unless the chat already has one covering more."""
+    with borrow() as conn:
+        conn.execute(
+            "UPDATE chats SET summary=?, summary_upto=? WHERE user_id=? AND title=? AND summary_upto<?",
+            (summary, summary_upto, user_id, title, summary_upto),
+        )
         conn.commit()
 
 def get_chats(user_id: str) -> List[Dict[str, Any]]:
-    with _connect() as conn:
+    with borrow() as conn:
         rows = conn.execute("SELECT title, updated_at FROM chats WHERE user_id=? ORDER BY updated_at DESC", (user_id,)).fetchall()
         return [{"title": r["title"], "updated_at": r["updated_at"]} for r in rows]
 
-def get_chat_messages_with_state(user_id: str, title: str) -> Optional[Tuple[List[Dict[str, Any]], Dict[str, Any]]]:
-    with _connect() as conn:
-        row = conn.execute("SELECT messages_json, mentor_topics, current_topic, completed_topics FROM chats WHERE user_id=? AND title=?", (user_id, title)).fetchone()
+def _chat_state(row: sqlite3.Row) -> Dict[str, Any]:
+    try:
+        mentor_topics = orjson.loads(row["mentor_topics"] or "[]")
+    except Exception:
+        mentor_topics = []
+    try:
+        completed_topics = orjson.loads(row["completed_topics"] or "[]")
+    except Exception:
+        completed_topics = []
+    return {"mentor_topics": mentor_topics, "current_topic": row["current_topic"], "completed_topics": completed_topics}
+
+def get_chat_state(user_id: str, title: str) -> Optional[Dict[str, Any]]:
+    """Topic state, rolling summary and `message_count` for a chat, without loading its messages."""
+    with borrow() as conn:
+        row = conn.execute("SELECT mentor_topics, current_topic, completed_topics, summary, summary_upto FROM chats WHERE user_id=? AND title=?", (user_id, title)).fetchone()
         if not row:
             return None
-        try:
-            messages = json.loads(row["messages_json"] or "[]")
-        except Exception:
-            messages = []
-        try:
-            mentor_topics = json.loads(row["mentor_topics"] or "[]")
-        except Exception:
-            mentor_topics = []
-        try:
-            completed_topics = json.loads(row["completed_topics"] or "[]")
-        except Exception:
-            completed_topics = []
-        state = {"mentor_topics": mentor_topics, "current_topic": row["current_topic"], "completed_topics": completed_topics}
-        return messages, state
+        state = _chat_state(row)
+        state["summary"] = row["summary"] or ""
+        state["summary_upto"] = row["summary_upto"]
+        state["message_count"] = conn.execute("SELECT COALESCE(MAX(seq) + 1, 0) FROM chat_messages WHERE user_id=? AND title=?", (user_id, title)).fetchone()[0]
+        return state
+
+def get_chat_messages_with_state(user_id: str, title: str, limit: Optional[int] = None) -> Optional[Tuple[List[Dict[str, Any]], Dict[str, Any]]]:
+    """Messages in order plus topic state; with `limit`, only the last `limit` messages are read."""
+    with borrow() as conn:
+        row = conn.execute("SELECT mentor_topics, current_topic, completed_topics FROM chats WHERE user_id=? AND title=?", (user_id, title)).fetchone()
+        if not row:
+            return None
+        if limit is None:
+            rows = conn.execute("SELECT role, content, ts, audio_url FROM chat_messages WHERE user_id=? AND title=? ORDER BY seq", (user_id, title)).fetchall()
+        else:
+            # Walks the primary key backwards from the newest message, so older rows are never touched
+            rows = conn.execute("SELECT role, content, ts, audio_url FROM chat_messages WHERE user_id=? AND title=? ORDER BY seq DESC LIMIT ?", (user_id, title, limit)).fetchall()
+            rows.reverse()
+        messages = [{"role": r["role"], "content": r["content"], "timestamp": r["ts"], "audio_url": r["audio_url"]} for r in rows]
+        return messages, _chat_state(row)
 
 def save_user_preferences(user_id: str, learning_goal: Optional[str], skills: List[str], difficulty: str, role: str) -> None:
-    with _connect() as conn:
+    with borrow() as conn:
         conn.execute(
             """
             INSERT INTO user_preferences (user_id, learning_goal, skills, difficulty, role, updated_at)
@@ -106,17 +235,17 @@ def save_user_preferences(user_id: str, learning_goal: Optional[str], skills: Li
               role=excluded.role,
               updated_at=excluded.updated_at
             """,
-            (user_id, learning_goal, json.dumps(skills or []), difficulty, role, _dt.datetime.utcnow().isoformat()),
+            (user_id, learning_goal, orjson.dumps(skills or []).decode(), difficulty, role, _utc_now_iso()),
         )
         conn.commit()
 
 def get_user_preferences(user_id: str) -> Optional[Dict[str, Any]]:
-    with _connect() as conn:
+    with borrow() as conn:
         row = conn.execute("SELECT learning_goal, skills, difficulty, role FROM user_preferences WHERE user_id=?", (user_id,)).fetchone()
         if not row:
             return None
         try:
-            skills = json.loads(row["skills"] or "[]")
+            skills = orjson.loads(row["skills"] or "[]")
         except Exception:
             skills = []
         return {"learning_goal": row["learning_goal"], "skills": skills, "difficulty": row["difficulty"], "role": row["role"]}
\ No newline at end of file
@@ -1,16 +1,25 @@
 from __future__ import annotations
-import sqlite3
+import sqlite3, threading
 from datetime import datetime
+from typing import Any, Dict, Iterable
 from pathlib import Path
 
 _DB_DIR = Path(__file__).resolve().parent.parent / "data"
 _DB_DIR.mkdir(parents=True, exist_ok=True)
 _DB_PATH = _DB_DIR / "user_history.db"
 
-_conn = sqlite3.connect(_DB_PATH, check_same_thread=False)
-_cur = _conn.cursor()
+# One connection per thread: WAL lets the worker threads read concurrently instead of queuing on a shared cursor
+_local = threading.local()
 
-_cur.execute("""
+def _get_conn() -> sqlite3.Connection:
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _local.conn = sqlite3.connect(_DB_PATH, cached_statements=256)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+_get_conn().execute("""
 CREATE TABLE IF NOT EXISTS users (
     user_id TEXT PRIMARY KEY,
     name TEXT,
@@ -22,31 +31,35 @@ CREATE TABLE IF NOT EXISTS users (
     created_at TEXT
 )
 """)
-_conn.commit()
+
+# Each query's text lives in one place so every call hits the connection's prepared-statement cache
+_CREATE_USER_SQL = "INSERT OR IGNORE INTO users (user_id, name, password, email, firm, unit, location, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+_GET_USER_SQL = "SELECT * FROM users WHERE user_id = ?"
+_ALL_USERS_SQL = "SELECT user_id, name, created_at FROM users ORDER BY created_at DESC"
+_UPDATE_NAME_SQL = "UPDATE users SET name = ? WHERE user_id = ?"
+_VALIDATE_LOGIN_SQL = "SELECT 1 FROM users WHERE user_id = ? AND password = ?"
 
 def create_user(user_id: str, name: str, password: str, email: str, firm: str, unit: str, location: str) -> None:
     now = datetime.utcnow().isoformat()
-    _cur.execute(
-        """
-        INSERT OR IGNORE INTO users (user_id, name, password, email, firm, unit, location, created_at)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """,
-        (user_id, name, password, email, firm, unit, location, now),
-    )
-    _conn.commit()
+    with _get_conn() as conn:
+        conn.execute(_CREATE_USER_SQL, (user_id, name, password, email, firm, unit, location, now))
+
+def create_users_bulk(users: Iterable[Dict[str, Any]]) -> None:
+    """create_user for many users in one transaction; each dict holds create_user's keyword arguments."""
+    now = datetime.utcnow().isoformat()
+    rows = [(u["user_id"], u["name"], u["password"], u["email"], u["firm"], u["unit"], u["location"], now) for u in users]
+    with _get_conn() as conn:
+        conn.executemany(_CREATE_USER_SQL, rows)
 
 def get_user(user_id: str):
-    _cur.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-    return _cur.fetchone()
+    return _get_conn().execute(_GET_USER_SQL, (user_id,)).fetchone()
 
 def get_all_users():
-    _cur.execute("SELECT user_id, name, created_at FROM users ORDER BY created_at DESC")
-    return _cur.fetchall()
+    return _get_conn().execute(_ALL_USERS_SQL).fetchall()
 
 def update_user_name(user_id: str, new_name: str) -> None:
-    _cur.execute("UPDATE users SET name = ? WHERE user_id = ?", (new_name, user_id))
-    _conn.commit()
+    with _get_conn() as conn:
+        conn.execute(_UPDATE_NAME_SQL, (new_name, user_id))
 
 def validate_login(user_id: str, password: str) -> bool:
-    _cur.execute("SELECT 1 FROM users WHERE user_id = ? AND password = ?", (user_id, password))
-    return _cur.fetchone() is not None
\ No newline at end of file
+    return _get_conn().execute(_VALIDATE_LOGIN_SQL, (user_id, password)).fetchone() is not None
\ No newline at end of file